@@ -8,163 +8,543 @@ import time
 import json
 import sys
 import os
+import platform
 import argparse
+import hashlib
 import re
-from typing import Dict, Tuple
+import shutil
+import threading
+from string import Template
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from typing import Dict, List, Optional, Tuple
 
-QUERIES_NUM = 14
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_QNUM_RE = re.compile(r"query_(\d+)\.sql$")
+MAX_ATTEMPTS = 5
+MAX_BACKOFF_S = 30
+COUNT_CHUNK_SIZE = 1 << 20  # bytes read at once when counting output rows
+
+# (minimum available memory in GiB, number of concurrent queries)
+PARALLELISM_TABLE = [
+    (64, 8),
+    (32, 4),
+    (16, 2),
+]
+
+
+@dataclass(frozen=True)
+class QueryStat:
+    """
+    Stats of one query run; every field is -1 if the query did not run.
+    """
+    elapsed: float  # milliseconds
+    row_count: int
+    max_rss_kb: int
+
+
+FAILED = QueryStat(-1, -1, -1)
+
+
+def write_json(path: str, obj) -> None:
+    """
+    Write obj as indented JSON, with orjson when it is installed.
+    """
+    if orjson is not None:
+        with open(path, "wb") as f:
+            f.write(orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY))
+    else:
+        with open(path, "w") as f:
+            json.dump(obj, f, indent=2)
+
+
+def positive_int(value: str) -> int:
+    """
+    argparse type for flags that need a value of at least 1.
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"must be an integer, got {value!r}")
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
+
+
+def non_negative_int(value: str) -> int:
+    """
+    argparse type for flags where 0 has a special meaning.
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"must be an integer, got {value!r}")
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"must be at least 0, got {value}")
+    return number
+
+
+def compute_parallelism() -> int:
+    """
+    Derive a worker count from the available memory headroom, so that
+    concurrent queries do not push each other into swap and skew max RSS.
+    """
+    if psutil is not None:
+        available = psutil.virtual_memory().available
+    else:
+        try:
+            available = os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+        except (AttributeError, ValueError, OSError):
+            return 1
+
+    available_gib = available / (1024 ** 3)
+    for min_gib, workers in PARALLELISM_TABLE:
+        if available_gib >= min_gib:
+            return max(1, min(workers, os.cpu_count() or 1))
+    return 1
+
+
+class RssSampler(threading.Thread):
+    """
+    Track the max RSS of a process by sampling it in the background
+    until stop() is called or the process exits. With relative=True,
+    the RSS at construction time is taken as a baseline and only the
+    growth above it is reported.
+    """
+
+    def __init__(self, pid: int, interval: float = 0.005, relative: bool = False):
+        super().__init__(daemon=True)
+        self.process = psutil.Process(pid)
+        self.interval = interval
+        self.baseline = self.process.memory_info().rss if relative else 0
+        self.max_rss = -1
+        self._stop_event = threading.Event()
+
+    def run(self) -> None:
+        while True:
+            try:
+                self.max_rss = max(self.max_rss, self.process.memory_info().rss)
+            except psutil.Error:
+                # Process exited or cannot be inspected anymore
+                break
+            if self._stop_event.wait(self.interval):
+                break
+
+    def stop(self) -> int:
+        """
+        Stop sampling.
+        Returns:
+            max_rss_kb (int) above the baseline, or -1 if no sample could be taken.
+        """
+        self._stop_event.set()
+        self.join()
+        if self.max_rss == -1:
+            return -1
+        return max(0, self.max_rss - self.baseline) // 1024
 
 
 class QueryRunner:
     def __init__(self, duckdb_path: str = "../../build/release/duckdb",
                        benchmark: str = "default",
                        queries_path: str = "./sql/memory",                       
-                       output_path: str = "./results/memory"):
+                       output_path: str = "./results/memory",
+                       parallel_workers: int = 1,
+                       fresh_process: bool = False,
+                       cache_dir: Optional[str] = None,
+                       skip_if_cached: bool = False,
+                       max_attempts: int = MAX_ATTEMPTS,
+                       drop_caches: bool = False):
         self.duckdb_path = duckdb_path
         self.benchmark = benchmark
         self.queries_path = queries_path        
         self.output_path = output_path
-        self.queries_num = QUERIES_NUM
-        self._warned_no_time = False   
+        self.parallel_workers = parallel_workers
+        # Concurrent queries always need their own process
+        self.fresh_process = fresh_process or parallel_workers > 1
+        self.cache_dir = cache_dir
+        self.skip_if_cached = skip_if_cached
+        if max_attempts < 1:
+            raise ValueError(f"max_attempts must be at least 1, got {max_attempts}")
+        self.max_attempts = max_attempts
+        self.failures = dict()  # filename -> error and number of attempts
+        # Queries running side by side would drop each other's cache
+        self.drop_caches = drop_caches and parallel_workers <= 1
+        # The DuckDB command line is the same for every query and retry
+        self._base_cmd = [duckdb_path, f"./databases/{benchmark}.db"]
+        if parallel_workers > 1:
+            # Concurrent processes cannot share the read-write lock
+            self._base_cmd.insert(1, "-readonly")
+        self._warned_no_psutil = False
+        self._print_lock = threading.Lock()
+        self._session = None  # long-lived DuckDB process, see _start_session
+        self._session_queries = 0
 
     # ---------- Helpers for memory measurement ----------
 
-    def _wrap_with_time(self, base_cmd):
-        # Try GNU time on macOS
-        if os.path.exists("/usr/local/bin/gtime"):
-            return ["/usr/local/bin/gtime", "-v"] + base_cmd, True
+    def _start_sampler(self, pid: int, relative: bool = False) -> Optional["RssSampler"]:
+        if psutil is None:
+            if not self._warned_no_psutil:
+                self._emit(["\tWarning: psutil not found, memory will not be measured."])
+                self._warned_no_psutil = True
+            return None
+        try:
+            sampler = RssSampler(pid, relative=relative)
+        except psutil.Error:
+            # Process already exited
+            return None
+        sampler.start()
+        return sampler
+
+    # ----------------------------------------------------
+
+    def _start_session(self) -> None:
+        """
+        Start one DuckDB process that runs all queries, so that process
+        startup and database attach are only paid once.
+        """
+        self._session = subprocess.Popen(
+            self._base_cmd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            # Errors end up in the same stream, before the sentinel
+            stderr=subprocess.STDOUT,
+            text=True,
+            bufsize=1
+        )
+        self._session_queries = 0
 
-        # Try GNU time on Linux
-        if os.path.exists("/usr/bin/time"):
-            return ["/usr/bin/time", "-v"] + base_cmd, True
+        # Wait until the database is attached, so that the RSS baseline
+        # of the first query does not include the startup
+        try:
+            self._session.stdin.write(".shell echo SESSION_READY\n")
+            self._session.stdin.flush()
+        except OSError:
+            return
+        self._read_until("SESSION_READY")
 
-        # No GNU time available
-        if not self._warned_no_time:
-            print("\tWarning: GNU time not found, memory will not be measured.")
-            self._warned_no_time = True
+    def _read_until(self, sentinel: str) -> Tuple[bool, List[str]]:
+        """
+        Read session output up to the sentinel line.
+        Returns:
+            whether the sentinel was seen, and the lines before it
+        """
+        output = []
+        for line in self._session.stdout:
+            if line.strip() == sentinel:
+                return True, output
+            output.append(line)
+        return False, output
 
-        return base_cmd, False
+    def _stop_session(self) -> None:
+        if self._session is None:
+            return
+        try:
+            self._session.stdin.write(".quit\n")
+            self._session.stdin.close()
+            self._session.wait(timeout=30)
+        except (OSError, subprocess.TimeoutExpired):
+            self._session.kill()
+            self._session.wait()
+        self._session = None
 
-    def _parse_max_rss(self, stderr: str) -> int:
+    def _run_in_session(self, sql: str) -> Tuple[bool, str, int]:
         """
-        Parse 'Maximum resident set size (kbytes)' from /usr/bin/time -v output.
+        Stream a query into the long-lived DuckDB process and wait for
+        its sentinel line.
         Returns:
-            max_rss_kb (int) or -1 if not found / cannot parse.
+            success, error output, max_rss_kb (or -1 if not measured)
         """
-        if not stderr:
-            return -1
-        for line in stderr.splitlines():
-            # Example: "Maximum resident set size (kbytes): 123456"
-            m = re.search(r"Maximum resident set size.*?([0-9]+)", line)
-            if m:
-                try:
-                    return int(m.group(1))
-                except ValueError:
-                    return -1
-        return -1
+        if self._session is None:
+            self._start_session()
+
+        self._session_queries += 1
+        sentinel = f"QUERY_DONE_{self._session_queries}"
+        # The session keeps memory from earlier queries (buffer pool,
+        # allocator caches), so only the growth during this query is kept
+        sampler = self._start_sampler(self._session.pid, relative=True)
+
+        try:
+            # Reset .output so the result file is closed before the sentinel.
+            # The sentinel is echoed by a child process, which does not
+            # depend on DuckDB flushing its own stdout.
+            self._session.stdin.write(f"{sql}\n.output\n.shell echo {sentinel}\n")
+            self._session.stdin.flush()
+        except OSError as e:
+            if sampler is not None:
+                sampler.stop()
+            self._stop_session()
+            return False, str(e), -1
+
+        done, output = self._read_until(sentinel)
+        max_rss_kb = sampler.stop() if sampler is not None else -1
+
+        if not done:
+            # DuckDB exited before reaching the sentinel
+            output.append(f"DuckDB exited with code {self._session.wait()}")
+            self._session = None
+            return False, "".join(output), -1
+
+        error = "".join(output)
+        return "Error" not in error, error, max_rss_kb
+
+    def _run_in_process(self, sql: str) -> Tuple[bool, str, int]:
+        """
+        Run a query in a fresh DuckDB process.
+        Returns:
+            success, error output, max_rss_kb (or -1 if not measured)
+        """
+        process = subprocess.Popen(
+            self._base_cmd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True
+        )
+        sampler = self._start_sampler(process.pid)
+        _, stderr = process.communicate(sql)
+        max_rss_kb = sampler.stop() if sampler is not None else -1
+
+        return process.returncode == 0, stderr, max_rss_kb
+
+    # ---------- Helpers for the result cache ----------
+
+    def _cache_paths(self, sql: str) -> Tuple[str, str]:
+        """
+        Paths of the cached stats and CSV output, keyed on the SQL text
+        and the measurement mode, since max_rss_kb differs between modes.
+        """
+        key = hashlib.sha256(sql.encode()).hexdigest()
+        mode = "fresh" if self.fresh_process else "session"
+        prefix = os.path.join(self.cache_dir, f"{self.benchmark}_{mode}_{key}")
+        return f"{prefix}.json", f"{prefix}.csv"
+
+    def _load_cached(self, sql: str, filename: str) -> Optional[QueryStat]:
+        """
+        Restore the output of a previous run of the same SQL.
+        Returns:
+            QueryStat or None on a cache miss.
+        """
+        stats_path, csv_path = self._cache_paths(sql)
+        if not os.path.exists(stats_path) or not os.path.exists(csv_path):
+            return None
+        with open(stats_path, "r") as f:
+            stats = json.load(f)
+        shutil.copyfile(csv_path, self._output_file(filename))
+        return QueryStat(**stats)
+
+    def _store_cached(self, sql: str, filename: str, stat: QueryStat) -> None:
+        stats_path, csv_path = self._cache_paths(sql)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        shutil.copyfile(self._output_file(filename), csv_path)
+        write_json(stats_path, asdict(stat))
 
     # ----------------------------------------------------
 
-    def run_sql(self, filename: str) -> Tuple[float, int, int]:
+    def _emit(self, lines: List[str]) -> None:
+        """
+        Print a block of log lines at once, so that output of queries
+        running in parallel is not interleaved.
+        """
+        with self._print_lock:
+            print("\n".join(lines), flush=True)
+
+    def run_sql(self, filename: str) -> QueryStat:
         """
         Run a single query SQL file.
 
         Returns:
-            elapsed_ms : float
-            line_count : int
-            max_rss_kb : int (or -1 if not measured)
+            QueryStat, with max_rss_kb -1 if not measured,
+            or FAILED if the query could not be run.
         """
-        success = False
-        print(f"\nRunning {filename}")
-        start_time = time.time()
+        log = [f"\nRunning {filename}"]
         sql_path = os.path.join(self.queries_path, filename)
         if not os.path.exists(sql_path):
-            print(f"\tError: Query file not found: {sql_path}")
-            return -1, -1, -1
+            log.append(f"\tError: Query file not found: {sql_path}")
+            self._emit(log)
+            return FAILED
         
+        # The query files are templates writing to ${out_dir}
         with open(sql_path, "r") as f:
-            sql = f.read()
-
-        # Adjust .output path to include benchmark name
-        sql = sql.replace(".output results/memory/query",
-                          f".output results/memory/{self.benchmark}/query")
-
-        max_rss_kb = -1  # default dont measure memory
-
-        while not success:
-            base_cmd = [self.duckdb_path, f"./databases/{self.benchmark}.db"]
-            cmd, use_time = self._wrap_with_time(base_cmd)
-
-            result = subprocess.run(
-                cmd,
-                input=sql,
-                capture_output=True,
-                text=True
-            )
-            if result.returncode == 0:
-                success = True
+            sql = Template(f.read()).substitute(out_dir=f"{self.output_path}/{self.benchmark}")
+
+        if self.cache_dir and self.skip_if_cached:
+            cached = self._load_cached(sql, filename)
+            if cached is not None:
+                log.append(f"\tUsing cached result ({cached.elapsed:.2f}ms, {cached.row_count} rows, "
+                           f"{cached.max_rss_kb} kB)")
+                self._emit(log)
+                return cached
+
+        # Only pay for dropping the page cache when the query actually runs
+        if self.drop_caches:
+            self.drop_page_cache()
+
+        for attempt in range(self.max_attempts):
+            if not self.fresh_process and self._session is None:
+                # Startup and attach (also after a crash) are not part of the query time
+                self._start_session()
+            start_time = time.time()
+            if self.fresh_process:
+                success, error, max_rss_kb = self._run_in_process(sql)
             else:
-                print(f"\tError running query: {result.stderr}")
-                print("\tTrying again...")
-                time.sleep(1)
-                start_time = time.time()
+                success, error, max_rss_kb = self._run_in_session(sql)
+            if success:
+                break
+            log.append(f"\tError running query: {error}")
+            if attempt + 1 < self.max_attempts:
+                backoff = min(MAX_BACKOFF_S, 2 ** attempt)
+                log.append(f"\tTrying again in {backoff}s...")
+                time.sleep(backoff)
+        else:
+            log.append(f"\tGiving up after {self.max_attempts} attempts")
+            self._emit(log)
+            self.failures[filename] = {
+                "error": error[-4000:],
+                "attempts": self.max_attempts
+            }
+            return FAILED
 
         end_time = time.time()
         elapsed = (end_time - start_time) * 1000  # milliseconds
 
-        # If wrapped with /usr/bin/time, parse its stderr for max RSS
-        if use_time:
-            max_rss_kb = self._parse_max_rss(result.stderr)
-
-        print(f"\tDone in {elapsed:.2f}ms")
+        log.append(f"\tDone in {elapsed:.2f}ms")
 
         line_count = self.run_validation(filename)
-        print(f"\tOutput row count: {line_count}")
-        if use_time:
-            print(f"\tMax RSS: {max_rss_kb} kB")
+        log.append(f"\tOutput row count: {line_count}")
+        if max_rss_kb != -1:
+            log.append(f"\tMax RSS: {max_rss_kb} kB")
+        self._emit(log)
 
-        return elapsed, line_count, max_rss_kb
+        stat = QueryStat(elapsed, line_count, max_rss_kb)
+        if self.cache_dir and line_count != -1:
+            self._store_cached(sql, filename, stat)
+
+        return stat
+
+    def _output_file(self, filename: str) -> str:
+        return f"{self.output_path}/{self.benchmark}/{filename.replace('.sql', '.csv')}"
 
     def run_validation(self, filename: str) -> int:
         """
         Count rows in the CSV output corresponding to this query.
         Assumes a header row and subtracts 1 from the line count.
         """
-        output_file = f"{self.output_path}/{self.benchmark}/{filename.replace('.sql', '.csv')}"
+        output_file = self._output_file(filename)
         if not os.path.exists(output_file):
-            print(f"\tError: Output file not found: {output_file}")
+            self._emit([f"\tError: Output file not found: {output_file}"])
             return -1
-        with open(output_file, "r") as f:
-            line_count = sum(1 for _ in f)
+        # Count newlines in large binary chunks instead of iterating lines
+        line_count = 0
+        last_chunk = b""
+        with open(output_file, "rb") as f:
+            for chunk in iter(lambda: f.read(COUNT_CHUNK_SIZE), b""):
+                line_count += chunk.count(b"\n")
+                last_chunk = chunk
+        if last_chunk and not last_chunk.endswith(b"\n"):
+            line_count += 1  # last line without trailing newline
         if line_count > 0:
             line_count -= 1
         return line_count
 
+    def drop_page_cache(self) -> None:
+        """
+        Drop the OS page cache, so that every query starts cold.
+        Requires passwordless sudo (or a prior `sudo -v`); on failure,
+        a warning is printed once and caches are not dropped anymore.
+        """
+        if platform.system() == "Darwin":
+            cmd = ["sudo", "-n", "purge"]
+        else:
+            cmd = ["sudo", "-n", "sh", "-c", "sync && echo 3 > /proc/sys/vm/drop_caches"]
+        try:
+            result = subprocess.run(cmd, capture_output=True, text=True)
+            error = result.stderr.strip() if result.returncode != 0 else None
+        except OSError as e:
+            error = str(e)
+        if error is not None:
+            self._emit([f"\tWarning: could not drop page cache, disabling --drop-caches: {error}"])
+            self.drop_caches = False
+
+    def query_files(self) -> List[str]:
+        """
+        List the query_N.sql files in queries_path, ordered by N.
+        """
+        numbered = []
+        with os.scandir(self.queries_path) as entries:
+            for entry in entries:
+                m = _QNUM_RE.match(entry.name)
+                if m and entry.is_file():
+                    numbered.append((int(m.group(1)), entry.name))
+        return [name for _, name in sorted(numbered)]
+
     def run_queries(self) -> Dict:
         """
-        Run all queries from query_1.sql to query_{QUERIES_NUM}.sql
+        Run all query_N.sql files found in queries_path, ordered by N,
         and store elapsed time, row count, and max RSS in a dict.
+        Queries that keep failing are recorded with their last error.
+        Unless fresh processes are requested, all queries share one
+        DuckDB process. With more than one worker, queries are dispatched
+        concurrently; each child process is still measured on its own.
         """
-        results = dict()
+        filenames = self.query_files()
 
-        for query_num in range(1, self.queries_num + 1):
-            filename = f"query_{query_num}.sql"
-            elapsed, line_count, max_rss_kb = self.run_sql(filename)
-            if elapsed != -1:
-                results[filename] = {
-                    "elapsed": elapsed,
-                    "row_count": line_count,
-                    "max_rss_kb": max_rss_kb
-                }
+        # stats[i] always belongs to filenames[i], whatever the completion order
+        if self.parallel_workers > 1:
+            with ThreadPoolExecutor(max_workers=self.parallel_workers) as executor:
+                stats = list(executor.map(self.run_sql, filenames))
+        elif self.fresh_process:
+            stats = [self.run_sql(filename) for filename in filenames]
+        else:
+            # The session is started by the first query that is not cached
+            try:
+                stats = [self.run_sql(filename) for filename in filenames]
+            finally:
+                self._stop_session()
+
+        results = dict()
+        for filename, stat in zip(filenames, stats):
+            if stat.elapsed != -1:
+                results[filename] = asdict(stat)
+            elif filename in self.failures:
+                results[filename] = self.failures[filename]
         
         return results
 
 def main():
     parser = argparse.ArgumentParser(description="Data loader for Memory Comparison")
     parser.add_argument("--benchmark", type=str, required=True, help="Name of the benchmark run")    
+    # A string default goes through type, so a bad $PARALLEL_BATCHES is a usage error
+    parser.add_argument("--parallel-workers", type=non_negative_int,
+                        default=os.environ.get("PARALLEL_BATCHES", "1"),
+                        help="Number of queries to run concurrently, 0 to derive it from available memory "
+                             "(default: $PARALLEL_BATCHES or 1)")
+    parser.add_argument("--fresh-process", action="store_true",
+                        help="Start a new DuckDB process for every query, e.g. for cold-cache numbers")
+    parser.add_argument("--max-attempts", type=positive_int, default=MAX_ATTEMPTS,
+                        help=f"Number of times a failing query is run before giving up (default: {MAX_ATTEMPTS})")
+    parser.add_argument("--drop-caches", action="store_true",
+                        help="Drop the OS page cache before every query (requires sudo, ignored in parallel mode)")
+    parser.add_argument("--cache-dir", type=str, default=None,
+                        help="Directory where the stats and output of each query are cached, keyed on its SQL")
+    parser.add_argument("--skip-if-cached", action="store_true",
+                        help="Reuse the cached stats and output instead of running a query again")
     args = parser.parse_args()
+    if args.skip_if_cached and not args.cache_dir:
+        parser.error("--skip-if-cached requires --cache-dir")
 
     benchmark = args.benchmark    
+    parallel_workers = args.parallel_workers
+    if parallel_workers == 0:
+        parallel_workers = compute_parallelism()
 
     if not os.path.exists(f"./results/memory/{benchmark}"):
         os.makedirs(f"./results/memory/{benchmark}")
@@ -174,16 +554,28 @@ def main():
         print(f"Error: DuckDB executable not found at {duckdb_path}")
         print("Please make sure you're running this from the benchmark directory and DuckDB is built.")
         sys.exit(1)
+
+    queries_path = "./sql/memory"
+    if not os.path.isdir(queries_path):
+        print(f"Error: Query directory not found at {queries_path}")
+        print("Please make sure you're running this from the benchmark directory.")
+        sys.exit(1)
     
-    runner = QueryRunner(duckdb_path, benchmark)    
+    runner = QueryRunner(duckdb_path, benchmark,
+                         queries_path=queries_path,
+                         parallel_workers=parallel_workers,
+                         fresh_process=args.fresh_process,
+                         cache_dir=args.cache_dir,
+                         skip_if_cached=args.skip_if_cached,
+                         max_attempts=args.max_attempts,
+                         drop_caches=args.drop_caches)    
     results = runner.run_queries()
     
     if not os.path.exists(f"./results/stats/{benchmark}"):
         os.makedirs(f"./results/stats/{benchmark}")
     
     stats_filename = "run_queries_memory.json" 
-    with open(f"./results/stats/{benchmark}/{stats_filename}", "w") as f:
-        json.dump(results, f, indent=4)
+    write_json(f"./results/stats/{benchmark}/{stats_filename}", results)
     
     print(f"\nResults saved to ./results/stats/{benchmark}/{stats_filename}")
 
@@ -2,22 +2,25 @@ import json
 import re
 from pathlib import Path
 
+import matplotlib
+matplotlib.use("Agg")  # only writes PNGs, no need to probe GUI backends
 import matplotlib.pyplot as plt
+import numpy as np
 
 # Change this to the file you want, e.g. hanoi0.005/run_queries_memory.json
 JSON_PATH = Path("hanoi0.005/run_queries_memory.json")
 
+_QNUM_RE = re.compile(r"query_(\d+)\.sql$")
+
 def qnum(name: str) -> int:
-    m = re.search(r"query_(\d+)\.sql$", name)
+    m = _QNUM_RE.search(name)
     if not m:
         raise ValueError(f"Bad query key: {name}")
     return int(m.group(1))
 
-def kb_to_gib(kb: float) -> float:
-    return kb / (1024 * 1024)
-
 data = json.loads(JSON_PATH.read_text(encoding="utf-8"))
-by_num = {qnum(k): v for k, v in data.items()}
+# Failed queries are recorded with an "error" instead of stats
+by_num = {qnum(k): v for k, v in data.items() if "elapsed" in v}
 
 pairs = []
 for odd in sorted(n for n in by_num if n % 2 == 1):
@@ -29,41 +32,45 @@ if not pairs:
     raise SystemExit(f"No odd/even pairs found in {JSON_PATH}")
 
 labels = [f"q{odd}/q{odd+1}" for odd, _, _ in pairs]
-pts_elapsed = [odd_s["elapsed"] for _, odd_s, _ in pairs]
-mob_elapsed = [even_s["elapsed"] for _, _, even_s in pairs]
-pts_rss = [kb_to_gib(odd_s["max_rss_kb"]) for _, odd_s, _ in pairs]
-mob_rss = [kb_to_gib(even_s["max_rss_kb"]) for _, _, even_s in pairs]
 
-x = list(range(len(labels)))
+# Columns: points elapsed, trajectory elapsed, points RSS, trajectory RSS
+arr = np.empty((len(pairs), 4), dtype=np.float64)
+for i, (_, odd_s, even_s) in enumerate(pairs):
+    arr[i] = (odd_s["elapsed"], even_s["elapsed"], odd_s["max_rss_kb"], even_s["max_rss_kb"])
+arr[:, 2:] /= 1024 * 1024  # kB -> GiB
+pts_elapsed, mob_elapsed, pts_rss, mob_rss = arr.T
+
+x = np.arange(len(labels))
 w = 0.42
 
 outdir = Path("figures")
 outdir.mkdir(exist_ok=True)
 
-# Figure 1: elapsed per pair (2 bars each)
-plt.figure(figsize=(max(8, 1.2 * len(labels)), 4))
-plt.bar([i - w/2 for i in x], pts_elapsed, width=w, label="Points-Based (DuckDB+Spatial)")
-plt.bar([i + w/2 for i in x], mob_elapsed, width=w, label="Trajectory-Based (MobilityDuck+Spatial)")
-plt.xticks(x, labels, rotation=0)
-plt.xlabel("Query pair")
-plt.ylabel("Elapsed (s)")
-plt.title(f"Elapsed time")
-plt.legend()
-plt.tight_layout()
-plt.savefig(outdir / f"{JSON_PATH.parent.name}_elapsed_pairs.png", dpi=200)
-
-# Figure 2: max RSS per pair (2 bars each)
-plt.figure(figsize=(max(8, 1.2 * len(labels)), 4))
-plt.bar([i - w/2 for i in x], pts_rss, width=w, label="Points-Based (DuckDB+Spatial)")
-plt.bar([i + w/2 for i in x], mob_rss, width=w, label="Trajectory-Based (MobilityDuck+Spatial)")
-plt.xticks(x, labels, rotation=0)
-plt.xlabel("Query pair")
-plt.ylabel("Max RSS (GiB)")
-plt.title(f"Max RSS")
-plt.legend()
-plt.tight_layout()
-plt.savefig(outdir / f"{JSON_PATH.parent.name}_rss_pairs.png", dpi=200)
+elapsed_png = outdir / f"{JSON_PATH.parent.name}_elapsed_pairs.png"
+rss_png = outdir / f"{JSON_PATH.parent.name}_rss_pairs.png"
+
+# One Figure is reused for both plots, cleared between draws.
+# The constrained layout is solved when saving, not on every change.
+fig, ax = plt.subplots(figsize=(max(8, 1.2 * len(labels)), 4), layout="constrained")
+
+def plot_pairs(pts, mob, ylabel, title, path):
+    """Draw one bar chart (2 bars per query pair) and save it to path."""
+    ax.clear()
+    ax.bar(x - w/2, pts, width=w, label="Points-Based (DuckDB+Spatial)")
+    ax.bar(x + w/2, mob, width=w, label="Trajectory-Based (MobilityDuck+Spatial)")
+    ax.set_xticks(x, labels, rotation=0)
+    ax.set_xlabel("Query pair")
+    ax.set_ylabel(ylabel)
+    ax.set_title(title)
+    ax.legend()
+    fig.savefig(path, dpi=200)
+
+# Figure 1: elapsed per pair
+plot_pairs(pts_elapsed, mob_elapsed, "Elapsed (s)", "Elapsed time", elapsed_png)
+
+# Figure 2: max RSS per pair
+plot_pairs(pts_rss, mob_rss, "Max RSS (GiB)", "Max RSS", rss_png)
 
 print("Saved:")
-print(" -", outdir / f"{JSON_PATH.parent.name}_elapsed_pairs.png")
-print(" -", outdir / f"{JSON_PATH.parent.name}_rss_pairs.png")
+print(" -", elapsed_png)
+print(" -", rss_png)
@@ -1,6 +1,6 @@
 
 .mode csv
-.output results/memory/query_1.csv
+.output ${out_dir}/query_1.csv
 
 -- point based of query 3
 
@@ -1,5 +1,5 @@
 .mode csv
-.output results/memory/query_10.csv
+.output ${out_dir}/query_10.csv
 
 /* 13-traj*/
    
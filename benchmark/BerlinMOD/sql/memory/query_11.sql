@@ -1,5 +1,5 @@
 .mode csv
-.output results/memory/query_11.csv  
+.output ${out_dir}/query_11.csv  
 
 -- Point based version of query 14
 WITH BasePoints AS (
@@ -1,5 +1,5 @@
 .mode csv
-.output results/memory/query_12.csv
+.output ${out_dir}/query_12.csv
 
 -- Traj based version of query 14
 WITH Temp AS (
@@ -1,5 +1,5 @@
 .mode csv
-.output results/memory/query_13.csv
+.output ${out_dir}/query_13.csv
 
 -- Point -query 17
 
@@ -1,5 +1,5 @@
 .mode csv
-.output results/memory/query_14.csv
+.output ${out_dir}/query_14.csv
 
 -- trajectory of query 17 
 WITH PointCount AS (
@@ -1,5 +1,5 @@
 .mode csv
-.output results/memory/query_2.csv
+.output ${out_dir}/query_2.csv
 
 -- original of query 3
 
@@ -1,5 +1,5 @@
 .mode csv
-.output results/memory/query_3.csv
+.output ${out_dir}/query_3.csv
 
 -- Point-based of query 4
 
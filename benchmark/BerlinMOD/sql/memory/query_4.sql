@@ -1,5 +1,5 @@
 .mode csv
-.output results/memory/query_4.csv
+.output ${out_dir}/query_4.csv
 
 -- Trajectory of query 4
 SELECT DISTINCT p.PointId, p.Geom, v.Licence
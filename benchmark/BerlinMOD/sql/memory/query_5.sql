@@ -1,5 +1,5 @@
 .mode csv
-.output results/memory/query_5.csv
+.output ${out_dir}/query_5.csv
 
 -- Point version of query 7 
 WITH Timestamps AS (
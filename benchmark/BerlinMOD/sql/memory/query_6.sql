@@ -1,5 +1,5 @@
 .mode csv
-.output results/memory/query_6.csv
+.output ${out_dir}/query_6.csv
 
 -- Trajectory version of query 7
 WITH Timestamps AS (
@@ -1,5 +1,5 @@
 .mode csv
-.output results/memory/query_7.csv
+.output ${out_dir}/query_7.csv
 
 -- Point-based version of query 9
 WITH PointsInPeriod AS (
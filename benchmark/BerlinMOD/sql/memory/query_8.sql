@@ -1,5 +1,5 @@
 .mode csv
-.output results/memory/query_8.csv
+.output ${out_dir}/query_8.csv
 
 -- Trajectory version of query 9
 WITH Distances AS (
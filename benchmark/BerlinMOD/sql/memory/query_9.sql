@@ -1,5 +1,5 @@
 .mode csv
-.output results/memory/query_9.csv  
+.output ${out_dir}/query_9.csv  
 
 -- Point based version of query 13 
 WITH Temp AS (
@@ -1,19 +1,20 @@
-import os
-import json
+import io
+from pathlib import Path
+
+import duckdb
+
+# Loadable extension produced by the debug build, must match the DuckDB Python client version
+EXTENSION_PATH = "./build/debug/extension/mobilityduck/mobilityduck.duckdb_extension"
 
 # We just take the first non-empty description and example for now
 get_spatial_functions_sql = """
-INSTALL json;
-LOAD json;
-
 SELECT
-    json({ 
-        name: function_name,
-        signatures: signatures,
-        tags: func_tags,
-        description: description,
-        example: example
-    })
+    type,
+    function_name AS name,
+    signatures,
+    func_tags AS tags,
+    description,
+    example
 FROM (
     SELECT
         function_type AS type,
@@ -28,9 +29,9 @@ FROM (
         list_filter(signatures, x -> len(x.examples) != 0)[1].examples[1] as example,
         any_value(tags) AS func_tags,
     FROM duckdb_functions() as funcs
-    WHERE function_type = '$FUNCTION_TYPE$'
+    WHERE
         -- function-specific tweaks
-        AND CASE function_name
+        CASE function_name
             -- TODO: https://github.com/duckdb/duckdb-spatial/pull/601#discussion_r2144753435
             WHEN '&&' THEN 'box' IN parameters
             ELSE true
@@ -42,23 +43,33 @@ FROM (
             func_tags['ext'] IS NULL
             AND function_name LIKE 'ST_%'
         )
-    ORDER BY function_name
-);
+)
+ORDER BY function_name;
 """
 
-def get_functions(function_type = 'scalar'):
-    functions = []
-    for line in os.popen("./build/debug/duckdb -list -noheader -c \"" + get_spatial_functions_sql.replace('$FUNCTION_TYPE$', function_type) + "\"").readlines():
-        functions.append(json.loads(line))
+FUNCTION_TYPES = ['scalar', 'aggregate', 'table', 'macro']
+
+def get_functions():
+    # Query the function catalog in-process, rows come back as native Python values
+    connection = duckdb.connect(config={'allow_unsigned_extensions': 'true'})
+    connection.load_extension(EXTENSION_PATH)
+    cursor = connection.execute(get_spatial_functions_sql)
+    columns = [column[0] for column in cursor.description]
+
+    functions = {function_type: [] for function_type in FUNCTION_TYPES}
+    for row in cursor.fetchall():
+        function = dict(zip(columns, row))
+        functions.setdefault(function['type'], []).append(function)
+    connection.close()
     return functions
 
 def write_table_of_contents(f, functions):
-    f.write('| Function | Summary |\n')
-    f.write('| --- | --- |\n')
+    rows = ['| Function | Summary |\n', '| --- | --- |\n']
     for function in functions:
         # Summary is the first line of the description
         summary = function['description'].split('\n')[0] if function['description'] else ""
-        f.write(f"| [`{function['name']}`](#{to_kebab_case(function['name'])}) | {summary} |\n")
+        rows.append(f"| [`{function['name']}`](#{to_kebab_case(function['name'])}) | {summary} |\n")
+    f.write("".join(rows))
 
 
 def to_kebab_case(name):
@@ -78,16 +89,18 @@ def guess_return_type_from_name(name):
 
 
 def main():
-    with open("./docs/functions.md", "w") as f:
+    # Build the whole document in memory and write it out once
+    with io.StringIO() as f:
 
         f.write("# DuckDB Spatial Function Reference\n\n")
 
         print("Collecting functions")
 
-        aggregate_functions = get_functions('aggregate')
-        scalar_functions = get_functions('scalar')
-        table_functions = get_functions('table')
-        macro_functions = get_functions('macro')
+        functions = get_functions()
+        aggregate_functions = functions['aggregate']
+        scalar_functions = functions['scalar']
+        table_functions = functions['table']
+        macro_functions = functions['macro']
 
         # Write function index
         f.write("## Function Index \n")
@@ -183,5 +196,7 @@ def main():
                 print(f"No example for {function['name']}")
             f.write("----\n\n")
 
+        Path("./docs/functions.md").write_text(f.getvalue(), encoding="utf-8")
+
 if __name__ == "__main__":
     main()